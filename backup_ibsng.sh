@@ -9,6 +9,7 @@ CONTAINER_NAME=${CONTAINER_NAME:-"ibsng"}
 BACKUP_DIR=${BACKUP_DIR:-"/tmp/ibsng_backup_files"}
 DB_USER=${DB_USER:-"ibs"}
 DB_NAME=${DB_NAME:-"IBSng"}
+COMPRESSOR=${COMPRESSOR:-"gzip"}  # e.g. "pigz -p 8" for parallel compression
 # -----------------
 
 # Create the backup directory if it doesn't exist
@@ -26,12 +27,15 @@ echo "Starting the backup process for the IBSng database..."
 COMMAND_TO_EXEC="su - postgres -c 'pg_dump -U ${DB_USER} -Fc ${DB_NAME}'"
 echo "Executing command in the container: ${COMMAND_TO_EXEC}"
 
-# Execute the command and pipe its output to gzip
-docker exec -i "${CONTAINER_NAME}" bash -c "${COMMAND_TO_EXEC}" | gzip > "${BACKUP_FILE_PATH}"
+# Execute the command and pipe its output to the compressor (gzip-compatible output)
+# ${COMPRESSOR} is intentionally unquoted so its arguments are split
+docker exec -i "${CONTAINER_NAME}" bash -c "${COMMAND_TO_EXEC}" | ${COMPRESSOR} > "${BACKUP_FILE_PATH}"
+# Save both exit statuses right away; the next command overwrites PIPESTATUS
+PIPE_STATUS=("${PIPESTATUS[@]}")
 
 # Check if the backup was successful
-# ${PIPESTATUS[0]} returns the exit status of the first command in the pipe.
-if [ ${PIPESTATUS[0]} -eq 0 ] && [ -s "${BACKUP_FILE_PATH}" ]; then
+# Both pg_dump (first command) and the compressor (second command) must succeed.
+if [ "${PIPE_STATUS[0]}" -eq 0 ] && [ "${PIPE_STATUS[1]}" -eq 0 ] && [ -s "${BACKUP_FILE_PATH}" ]; then
   echo "✅ Backup successfully created and compressed at the following path:"
   ls -lh "${BACKUP_FILE_PATH}"
   # Send the backup file path to standard output for the Python script to use
@@ -5,17 +5,40 @@
 # ======================================================================== #
 
 import os
+import codecs
+import selectors
+import shutil
 import subprocess
+import tempfile
 import time
 import jdatetime
-import json
+import logging
 import signal
 import sys
 import threading
 import telebot
-import re
+import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# orjson is much faster; the standard library json is used when it is not installed
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(data):
+        return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # --- Settings ---
@@ -24,79 +47,197 @@ BACKUP_DIR = "/tmp/ibsng_backup_files"
 DB_USER = "ibs"
 DB_NAME = "IBSng"
 RETENTION_DAYS = 3
+CLEANUP_INTERVAL_HOURS = 24  # Minimum interval between old backup cleanups (in hours)
 CONFIG_FILE = os.path.join(BASE_DIR, "config.json")
 MIN_INTERVAL_HOURS = 24  # Minimum interval between backups (in hours)
 POLL_INTERVAL_MINUTES = 20  # Check interval (in minutes)
+TELEGRAM_LONG_POLL_SECONDS = 60  # How long each getUpdates request waits for new messages
 BACKUP_SCRIPT = os.path.join(BASE_DIR, "backup_ibsng.sh")  # Path to backup bash script
 RESTORE_SCRIPT = os.path.join(BASE_DIR, "restore_ibsng.sh")  # Path to restore bash script
 TEMP_DIR = "/tmp/ibsng_restore"  # Temporary directory for restore files
+SEND_DOC_URL = "https://api.telegram.org/bot{}/sendDocument"  # Telegram sendDocument endpoint
+GET_FILE_URL = "https://api.telegram.org/file/bot{}/{}"  # Telegram file download endpoint
+GZIP_MAGIC = b"\x1f\x8b"  # First two bytes of every gzip stream
+RESTORE_FLUSH_SECONDS = 2.0  # Max delay before buffered restore output is sent to Telegram
+RESTORE_FLUSH_CHARS = 3500  # Max characters per restore output message (Telegram limit with markdown)
+
+# --- Telegram messages (constant texts built once at import) ---
+BOT_COMMANDS = [
+    telebot.types.BotCommand("status", "وضعیت"),
+    telebot.types.BotCommand("backup", "پشتیبان‌گیری"),
+    telebot.types.BotCommand("restore", "بازیابی"),
+    telebot.types.BotCommand("time", "تنظیم فاصله بکاپ")
+]
+BACKUP_CAPTION = "📦 *فایل بکاپ IBSng*\n\n" \
+                 "📅 *تاریخ:* `{now:%Y/%m/%d}`\n" \
+                 "🕐 *زمان:* `{now:%H:%M:%S}`\n\n" \
+                 "✅ *وضعیت:* بکاپ با موفقیت انجام شد"
+MSG_UNAUTHORIZED = "🚫 *دسترسی غیرمجاز*\n\n" \
+                   "❌ شما مجوز اجرای این دستور را ندارید"
+MSG_BACKUP_START = "🔄 *شروع عملیات بکاپ‌گیری*\n\n" \
+                   "⏳ لطفاً صبر کنید تا عملیات تکمیل شود..."
+MSG_BACKUP_RUNNING = "🔄 *بکاپ در حال انجام است*\n\n" \
+                     "⏳ یک عملیات بکاپ‌گیری هم‌اکنون در حال اجراست"
+MSG_BACKUP_ERROR = "❌ *خطا در بکاپ‌گیری*\n\n" \
+                   "🔴 عملیات بکاپ با خطا مواجه شد\n" \
+                   "📋 لطفاً لاگ‌ها را بررسی کنید"
+MSG_TIME_HELP = "⚙️ *تنظیم فاصله زمانی*\n\n" \
+                "📝 لطفاً یک عدد صحیح به عنوان فاصله زمانی (ساعت) وارد کنید\n\n" \
+                "💡 *مثال:* `/time 8`"
+MSG_TIME_INVALID = "❌ *خطا در مقدار*\n\n" \
+                   "🔴 فاصله زمانی باید عددی بزرگتر از صفر باشد"
+MSG_SAVE_ERROR = "❌ *خطا در ذخیره*\n\n" \
+                 "🔴 خطا در ذخیره تنظیمات\n" \
+                 "📋 لطفاً لاگ‌ها را بررسی کنید"
+MSG_RESTORE_GUIDE = "⚠️ *هشدار بسیار مهم*\n\n" \
+                    "🔴 عملیات بازیابی دیتابیس موجود را حذف کرده و با بکاپ جدید جایگزین خواهد کرد\n\n" \
+                    "📎 *فرمت‌های پشتیبانی شده:*\n" \
+                    "• `.bak`\n" \
+                    "• `.dump.gz`\n\n" \
+                    "📤 لطفاً فایل بکاپ معتبر را ارسال کنید\n\n" \
+                    "❌ برای لغو:\n" \
+                    "/cancel"
+MSG_RESTORE_SUCCESS = "✅ *بازیابی پایگاه داده موفقیت‌آمیز*\n\n" \
+                      "🎉 عملیات بازیابی با موفقیت کامل شد\n" \
+                      "📊 دیتابیس به حالت قبلی بازگردانده شد"
+MSG_CANCELLED = "✅ *عملیات لغو شد*\n\n" \
+                "🔄 عملیات بازیابی با موفقیت لغو شد"
+MSG_NO_OPERATION = "❌ *هیچ عملیات فعال نیست*\n\n" \
+                   "⚪ هیچ عملیات فعال برای لغو وجود ندارد"
+MSG_INVALID_GZIP = "❌ *فایل بکاپ نامعتبر*\n\n" \
+                   "🔴 فایل `.dump.gz` ارسال شده یک فایل gzip معتبر نیست"
+MSG_INVALID_FORMAT = "❌ *فرمت فایل نامعتبر*\n\n" \
+                     "🔴 پسوند فایل معتبر نیست\n\n" \
+                     "✅ *فرمت‌های مجاز:*\n" \
+                     "• `.bak`\n" \
+                     "• `.dump.gz`"
 
 # Global variables for graceful shutdown
-shutdown_flag = False
+shutdown_event = threading.Event()
 backup_lock = threading.Lock()
-config_lock = threading.Lock()
+backup_pending = threading.Lock()  # Held from /backup submit until that job finishes, so queued jobs count as running
+config_lock = threading.RLock()  # Serializes writers and reloads (re-entrant so update_config can call save_config); readers use the in-memory copy
 user_states = {}  # User states in Telegram
 
+# Single worker for bot-triggered backups and restores: bounded, reused, and never run side by side
+BACKUP_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+
+# Shared HTTP session so Telegram uploads, restore downloads and all telebot API calls
+# (getUpdates, sendMessage, getFile) reuse keep-alive TLS connections to api.telegram.org
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=8))
+telebot.apihelper.session = SESSION
+
+# Telegram bot instance (created in main when a token is configured)
+bot = None
+
 # Initial configuration loading
 config = {}
 bot_token = None
 chat_id = None
 
+def parse_chat_id(value):
+    """Convert the configured chat_id to int so handlers can compare it with message.chat.id directly"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
 def load_config():
-    """Load settings from config file"""
+    """Load settings from config file into the in-memory settings"""
     global config, bot_token, chat_id
-    try:
-        with config_lock:
-            if os.path.exists(CONFIG_FILE):
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                    bot_token = config.get('bot_token')
-                    chat_id = config.get('chat_id')
-            return config
-    except Exception as e:
-        print(f"❌ Error reading config file: {str(e)}")
-        return {}
+    # Take config_lock like writers do, so a SIGHUP reload waits for an in-flight
+    # update_config instead of being overwritten by its stale copy
+    with config_lock:
+        try:
+            with open(CONFIG_FILE, 'rb') as f:
+                data = json_loads(f.read())
+        except FileNotFoundError:
+            return dict(config)
+        except ValueError:
+            # Hand-edited file is not valid JSON; keep serving the last good copy
+            print(f"❌ Config file {CONFIG_FILE} is not valid JSON; keeping the current settings.")
+            return dict(config)
+        except Exception as e:
+            print(f"❌ Error reading config file: {str(e)}")
+            return dict(config)
+        config = data
+        bot_token = data.get('bot_token')
+        chat_id = parse_chat_id(data.get('chat_id'))
+        return dict(data)
+
+def get_config():
+    """Return a copy of the in-memory settings (kept current by save_config and SIGHUP reloads)"""
+    return dict(config)
 
 def save_config(config_data):
-    """Save settings to config file"""
+    """Save settings to config file and make them the in-memory settings"""
+    global config, bot_token, chat_id
     try:
         with config_lock:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump(config_data, f, indent=4, ensure_ascii=False)
+            # Write a temp file and rename it over config.json, so a crash mid-write
+            # can never leave a truncated config behind (0600: it holds the bot token)
+            tmp_file = CONFIG_FILE + '.tmp'
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, 'wb') as f:
+                f.write(json_dumps(config_data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, CONFIG_FILE)
+            # Swap in the saved settings so readers never need to go back to disk
+            config = dict(config_data)
+            bot_token = config.get('bot_token')
+            chat_id = parse_chat_id(config.get('chat_id'))
         return True
     except Exception as e:
         print(f"❌ Error saving config file: {str(e)}")
         return False
 
+def update_config(**changes):
+    """Merge changes into the current settings and save them as one step, so concurrent updates keep each other's keys"""
+    with config_lock:
+        # Start from the file, not the in-memory copy, so a hand edit saved before this write is not overwritten
+        config_data = load_config()
+        config_data.update(changes)
+        return save_config(config_data)
+
+def reload_handler(sig, frame):
+    """Handle reload signal (SIGHUP) by re-reading the config file"""
+    print("🔄 Reload signal received. Re-reading config file...")
+    load_config()
+
 def signal_handler(sig, frame):
     """Handle exit signals (Ctrl+C)"""
-    global shutdown_flag
     print("\n⚠️ Shutdown signal received. Gracefully exiting...")
-    shutdown_flag = True
+    shutdown_event.set()
+    if bot:
+        bot.stop_polling()
+
+def redact_token(text, token):
+    """Mask the bot token in error text; requests exceptions include the full /bot<TOKEN>/ URL"""
+    return text.replace(token, '***') if token else text
 
 def send_to_telegram(file_path, bot_token, chat_id):
-    """Send file to Telegram with Persian date caption using curl"""
+    """Send file to Telegram with Persian date caption as a streamed multipart upload"""
     try:
-        # Get current time in Persian (Shamsi) calendar
-        persian_date = jdatetime.datetime.now().strftime("%Y/%m/%d")
-        persian_time = jdatetime.datetime.now().strftime("%H:%M:%S")
-        caption = f"📦 *فایل بکاپ IBSng*\n\n" \
-                 f"📅 *تاریخ:* `{persian_date}`\n" \
-                 f"🕐 *زمان:* `{persian_time}`\n\n" \
-                 f"✅ *وضعیت:* بکاپ با موفقیت انجام شد"
+        # Get current time in Persian (Shamsi) calendar (converted once for date and time)
+        caption = BACKUP_CAPTION.format(now=jdatetime.datetime.now())
         
-        command = [
-            'curl',
-            '-X', 'POST',
-            f"https://api.telegram.org/bot{bot_token}/sendDocument",
-            '-F', f'chat_id={chat_id}',
-            '-F', f'document=@{file_path}',
-            '-F', f'caption={caption}',
-            '-F', 'parse_mode=Markdown'
-        ]
-        
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        response = json.loads(result.stdout)
+        # The encoder reads the file in chunks straight into the socket
+        with open(file_path, 'rb') as document:
+            encoder = MultipartEncoder(fields={
+                'chat_id': str(chat_id),
+                'caption': caption,
+                'parse_mode': 'Markdown',
+                'document': (os.path.basename(file_path), document, 'application/gzip')
+            })
+            resp = SESSION.post(
+                SEND_DOC_URL.format(bot_token),
+                data=encoder,
+                headers={'Content-Type': encoder.content_type},
+                timeout=(5, 300)
+            )
+        response = json_loads(resp.content)
         
         if response.get('ok'):
             print("✅ Backup file successfully sent to Telegram with Persian date caption.")
@@ -105,13 +246,24 @@ def send_to_telegram(file_path, bot_token, chat_id):
             print(f"❌ Error sending to Telegram: {response.get('description', 'Unknown error')}")
             return False
             
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Error executing curl: {e.stderr}")
+    except requests.RequestException as e:
+        print(f"❌ Error uploading to Telegram: {redact_token(str(e), bot_token)}")
         return False
     except Exception as e:
-        print(f"❌ Error sending to Telegram: {str(e)}")
+        print(f"❌ Error sending to Telegram: {redact_token(str(e), bot_token)}")
         return False
 
+def is_valid_gzip(file_path):
+    """Cheap gzip sanity check: deflate magic header and room for header plus CRC32/ISIZE trailer"""
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        # 10-byte header + 8-byte trailer is the smallest possible gzip member
+        if os.fstat(fd).st_size < 18:
+            return False
+        return os.pread(fd, 3, 0) == GZIP_MAGIC + b"\x08"
+    finally:
+        os.close(fd)
+
 def check_backup_interval(config_data):
     """Check time interval since last backup"""
     last_backup = config_data.get('last_backup')
@@ -174,16 +326,49 @@ def truncate_container_logs():
         print(f"❌ An unexpected error occurred during log truncation: {str(e)}")
 
 
+def cleanup_old_backups():
+    """Delete local backup files older than RETENTION_DAYS, at most once per CLEANUP_INTERVAL_HOURS"""
+    last_cleanup = get_config().get('last_cleanup', 0)
+    if time.time() - last_cleanup < CLEANUP_INTERVAL_HOURS * 3600:
+        return
+    
+    print(f"Deleting backups older than {RETENTION_DAYS} days...")
+    cutoff_time = time.time() - (RETENTION_DAYS * 86400)
+    try:
+        # DirEntry caches stat() results, so each file costs a single syscall
+        with os.scandir(BACKUP_DIR) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.dump.gz'):
+                    continue
+                if entry.stat().st_mtime < cutoff_time:
+                    os.unlink(entry.path)
+                    print(f"   Deleted old file: {entry.name}")
+        print("✅ Old backup cleanup completed successfully.")
+        
+        update_config(last_cleanup=time.time())
+    except FileNotFoundError:
+        print(f"⚠️ Backup directory {BACKUP_DIR} not found for cleanup. It might be created on first backup.")
+    except Exception as e:
+        print(f"❌ Error during old backup cleanup: {str(e)}")
+
 def run_backup_process(force=False):
-    """Execute complete backup process using bash script"""
+    """Execute complete backup process using bash script.
+
+    Returns True on success, False on failure, and None when another backup or restore holds backup_lock.
+    """
     
     # --- Step 1: Create backup within a lock ---
     backup_file_path = None
     telegram_send_ok = False
     backup_successful = False
 
-    with backup_lock:
-        config_data = load_config()
+    # Single-flight: a concurrent request is told a backup is running instead of queuing a second pg_dump
+    if not backup_lock.acquire(blocking=False):
+        print("⚠️ Another backup or restore is already in progress. Skipping this request.")
+        return None
+
+    try:
+        config_data = get_config()
         bot_token_local = config_data.get('bot_token')
         chat_id_local = config_data.get('chat_id')
 
@@ -195,142 +380,167 @@ def run_backup_process(force=False):
             'CONTAINER_NAME': CONTAINER_NAME,
             'BACKUP_DIR': BACKUP_DIR,
             'DB_USER': DB_USER,
-            'DB_NAME': DB_NAME
+            'DB_NAME': DB_NAME,
+            # Compress on all cores when pigz is installed; output stays plain gzip
+            'COMPRESSOR': f"pigz -p {os.cpu_count() or 2}" if shutil.which('pigz') else 'gzip'
         })
 
         print("Starting IBSng database backup process...")
         try:
-            result = subprocess.run(
+            # Stream the script's output line by line instead of buffering all of it
+            with subprocess.Popen(
                 [BACKUP_SCRIPT],
                 env=env,
-                capture_output=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
                 text=True,
-                check=True
-            )
+                bufsize=1
+            ) as process:
+                for line in process.stdout:
+                    if line.startswith('BACKUP_FILE_PATH='):
+                        backup_file_path = line[len('BACKUP_FILE_PATH='):].rstrip()
+                    else:
+                        sys.stdout.write(line)
+                returncode = process.wait()
 
-            for line in result.stdout.split('\n'):
-                if line.startswith('BACKUP_FILE_PATH='):
-                    backup_file_path = line.split('=', 1)[1]
-                    break
+            if returncode != 0:
+                print(f"❌ Error executing backup script (exit code {returncode})")
+                return False
 
-            if backup_file_path and os.path.exists(backup_file_path) and os.path.getsize(backup_file_path) > 0:
+            # One stat() answers both "does it exist" and "how big is it"
+            try:
+                file_size = os.stat(backup_file_path).st_size if backup_file_path else 0
+            except FileNotFoundError:
+                file_size = 0
+
+            if file_size > 0 and not is_valid_gzip(backup_file_path):
+                # Don't spend a long upload on a dump that is obviously broken
+                print("❌ Error: Backup file is not a valid gzip file. Upload skipped.")
+                backup_successful = False
+
+            elif file_size > 0:
                 print("✅ Backup created successfully:")
                 print(f"   File path: {backup_file_path}")
-                file_size = os.path.getsize(backup_file_path)
                 print(f"   File size: {file_size} bytes")
                 backup_successful = True
                 
                 # Send to Telegram and update config inside the lock to maintain data consistency
-                if bot_token_local and chat_id_local:
+                telegram_configured = bool(bot_token_local and chat_id_local)
+                if telegram_configured:
                     print("Sending file to Telegram...")
                     if send_to_telegram(backup_file_path, bot_token_local, chat_id_local):
-                        config_data['last_backup'] = time.time()
-                        save_config(config_data)
                         telegram_send_ok = True  # Flag that we should truncate logs later
                     else:
                         print("⚠️ Telegram send failed. Last backup time not updated.")
                 else:
                     print("⚠️ Telegram settings not found. Create config.json to send files.")
-                    config_data['last_backup'] = time.time()
-                    save_config(config_data)
+
+                # Record the backup once, unless an attempted Telegram send failed.
+                # Merged into the current settings so a /time change made during the backup is kept.
+                if telegram_send_ok or not telegram_configured:
+                    update_config(last_backup=time.time())
 
             else:
                 print("❌ Error: Backup file not created or size is zero.")
                 backup_successful = False
 
-        except subprocess.CalledProcessError as e:
-            print(f"❌ Error executing backup script: {e.stderr}")
-            return False
         except Exception as e:
             print(f"❌ Error in backup process: {str(e)}")
             return False
         finally:
             # --- Local file cleanup ---
             # This happens inside the lock's scope but after the main operations
-            if backup_file_path and os.path.exists(backup_file_path):
+            if backup_file_path:
                 try:
-                    print(f"🗑️ Deleting local backup file: {backup_file_path}")
                     os.remove(backup_file_path)
-                    print("✅ Local backup file deleted successfully.")
+                    print(f"🗑️ Deleted local backup file: {backup_file_path}")
+                except FileNotFoundError:
+                    pass
                 except OSError as e:
                     print(f"❌ Error deleting local backup file {backup_file_path}: {e}")
+    finally:
+        backup_lock.release()
 
     # --- Step 2: Post-backup tasks (outside the lock) ---
     if telegram_send_ok:
         truncate_container_logs()
 
     if backup_successful:
-        # --- Old backup cleanup ---
-        print(f"Deleting backups older than {RETENTION_DAYS} days...")
-        cutoff_time = time.time() - (RETENTION_DAYS * 86400)
-        try:
-            for filename in os.listdir(BACKUP_DIR):
-                if filename.endswith('.dump.gz'):
-                    file_path = os.path.join(BACKUP_DIR, filename)
-                    if os.path.getmtime(file_path) < cutoff_time:
-                        os.remove(file_path)
-                        print(f"   Deleted old file: {filename}")
-            print("✅ Old backup cleanup completed successfully.")
-        except FileNotFoundError:
-            print(f"⚠️ Backup directory {BACKUP_DIR} not found for cleanup. It might be created on first backup.")
-        except Exception as e:
-            print(f"❌ Error during old backup cleanup: {str(e)}")
+        cleanup_old_backups()
 
     return backup_successful
 
 def run_restore_process(file_path, chat_id):
     """Execute database restore process using bash script"""
     global bot
+    process = None
+    selector = None
+    # Hold backup_lock for the whole restore, so the polling thread never dumps a half-restored database
+    backup_lock.acquire()
     try:
-        # Execute bash restore script with auto 'y' response to confirmation
+        # Execute bash restore script directly and answer its confirmation prompt with 'y'
         process = subprocess.Popen(
-            f'echo "y" | {RESTORE_SCRIPT} "{file_path}"',
-            shell=True,
+            [RESTORE_SCRIPT, file_path],
+            stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+            stderr=subprocess.PIPE
         )
+        process.stdin.write(b"y\n")
+        process.stdin.close()
         
-        # Read output in chunks to send to Telegram
-        output_buffer = ""
-        while True:
-            output = process.stdout.read(1000)
-            if not output and process.poll() is not None:
-                break
-            if output:
-                output_buffer += output
-                # Send output in 3500 character chunks (Telegram limit with markdown)
-                if len(output_buffer) >= 3500:
-                    bot.send_message(
-                        chat_id, 
-                        f"```\n{output_buffer[:3500]}\n```", 
-                        parse_mode="Markdown"
-                    )
-                    output_buffer = output_buffer[3500:]
+        # Drain stdout and stderr together without blocking on either pipe
+        titles = {process.stdout: "", process.stderr: "⚠️ *خطاها:*\n"}
+        decoders = {pipe: codecs.getincrementaldecoder('utf-8')(errors='replace') for pipe in titles}
+        buffers = {pipe: "" for pipe in titles}
+        selector = selectors.DefaultSelector()
+        for pipe in titles:
+            os.set_blocking(pipe.fileno(), False)
+            selector.register(pipe, selectors.EVENT_READ)
         
-        # Send remaining output
-        if output_buffer:
-            bot.send_message(
-                chat_id, 
-                f"```\n{output_buffer}\n```", 
-                parse_mode="Markdown"
-            )
+        def send_output(pipe, text):
+            # A failed send (e.g. Telegram 429) must not stop the drain, or the script blocks on a full pipe
+            try:
+                bot.send_message(
+                    chat_id, 
+                    f"{titles[pipe]}```\n{text}\n```", 
+                    parse_mode="Markdown"
+                )
+            except Exception as e:
+                print(f"❌ Error sending restore output to Telegram: {str(e)}")
         
-        # Check for errors
-        stderr_output = process.stderr.read()
-        if stderr_output:
-            bot.send_message(
-                chat_id, 
-                f"⚠️ *خطاها:*\n```\n{stderr_output}\n```", 
-                parse_mode="Markdown"
-            )
+        # Coalesce output: send when a message is full, or when the flush window expires
+        last_flush = time.monotonic()
+        while selector.get_map():
+            for key, _ in selector.select(timeout=RESTORE_FLUSH_SECONDS):
+                data = os.read(key.fd, 65536)
+                if data:
+                    buffers[key.fileobj] += decoders[key.fileobj].decode(data)
+                else:
+                    buffers[key.fileobj] += decoders[key.fileobj].decode(b'', final=True)
+                    selector.unregister(key.fileobj)
+            
+            flush_all = not selector.get_map() or time.monotonic() - last_flush >= RESTORE_FLUSH_SECONDS
+            for pipe, text in buffers.items():
+                # Send full messages by offset (one copy of the tail at the end, not one per message),
+                # cutting at the last line break so lines are not split across messages
+                start = 0
+                while len(text) - start >= RESTORE_FLUSH_CHARS:
+                    cut = text.rfind('\n', start, start + RESTORE_FLUSH_CHARS)
+                    end = cut + 1 if cut > start else start + RESTORE_FLUSH_CHARS
+                    send_output(pipe, text[start:end].rstrip('\n'))
+                    start = end
+                text = text[start:]
+                if text and flush_all:
+                    send_output(pipe, text)
+                    text = ""
+                buffers[pipe] = text
+            if flush_all:
+                last_flush = time.monotonic()
+        process.wait()
         
         # Check final result
         if process.returncode == 0:
-            success_msg = "✅ *بازیابی پایگاه داده موفقیت‌آمیز*\n\n" \
-                         "🎉 عملیات بازیابی با موفقیت کامل شد\n" \
-                         "📊 دیتابیس به حالت قبلی بازگردانده شد"
-            bot.send_message(chat_id, success_msg, parse_mode="Markdown")
+            bot.send_message(chat_id, MSG_RESTORE_SUCCESS, parse_mode="Markdown")
         else:
             error_msg = f"❌ *بازیابی پایگاه داده ناموفق*\n\n" \
                        f"🔴 عملیات با خطا مواجه شد\n" \
@@ -353,17 +563,30 @@ def run_restore_process(file_path, chat_id):
             os.remove(file_path)
         except:
             pass
+    finally:
+        # Never leave the restore script running with nobody reading its pipes
+        if selector:
+            selector.close()
+        if process:
+            if process.poll() is None:
+                print("⚠️ Restore output handling failed; terminating the restore script.")
+                process.kill()
+            process.wait()
+            process.stdout.close()
+            process.stderr.close()
+        backup_lock.release()
 
 def backup_polling_thread():
     """Thread for periodic backup checks"""
-    global shutdown_flag
-    while not shutdown_flag:
+    while not shutdown_event.is_set():
         print(f"\n🔄 New check at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         
         # Execute backup process
         backup_success = run_backup_process(force=False)
         
-        if backup_success:
+        if backup_success is None:
+            print("⏭️ A backup or restore is already in progress, skipping this check")
+        elif backup_success:
             print("✅ Backup completed successfully")
         else:
             print("⚠️ Backup not performed in this check")
@@ -374,11 +597,9 @@ def backup_polling_thread():
         
         print(f"⏳ Waiting until next check: {wait_minutes} minutes")
         
-        # Wait with periodic check for shutdown signal
-        for _ in range(wait_seconds):
-            if shutdown_flag:
-                break
-            time.sleep(1)
+        # Sleep until the next check, waking immediately on shutdown
+        if shutdown_event.wait(wait_seconds):
+            return
 
 # Main function for Polling mode
 def main():
@@ -396,6 +617,7 @@ def main():
     # Set up signal handlers
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGHUP, reload_handler)
     
     # Load initial settings
     load_config()
@@ -407,18 +629,8 @@ def main():
     if bot_token:
         bot = telebot.TeleBot(bot_token)
         
-        # Define bot commands
-        def set_bot_commands():
-            commands = [
-                telebot.types.BotCommand("status", "وضعیت"),
-                telebot.types.BotCommand("backup", "پشتیبان‌گیری"),
-                telebot.types.BotCommand("restore", "بازیابی"),
-                telebot.types.BotCommand("time", "تنظیم فاصله بکاپ")
-            ]
-            bot.set_my_commands(commands)
-        
         # Set bot commands
-        set_bot_commands()
+        bot.set_my_commands(BOT_COMMANDS)
         
         @bot.message_handler(commands=['backup'])
         def handle_backup_command(message):
@@ -426,27 +638,34 @@ def main():
             global chat_id
             
             # Check user permission
-            if str(message.chat.id) != str(chat_id):
-                unauthorized_msg = "🚫 *دسترسی غیرمجاز*\n\n" \
-                                 "❌ شما مجوز اجرای این دستور را ندارید"
-                bot.reply_to(message, unauthorized_msg, parse_mode="Markdown")
+            if message.chat.id != chat_id:
+                bot.reply_to(message, MSG_UNAUTHORIZED, parse_mode="Markdown")
                 return
             
-            # Send start message
-            start_msg = "🔄 *شروع عملیات بکاپ‌گیری*\n\n" \
-                       "⏳ لطفاً صبر کنید تا عملیات تکمیل شود..."
-            bot.reply_to(message, start_msg, parse_mode="Markdown")
+            # Answer right away instead of queuing a second backup behind one that is queued or running
+            if not backup_pending.acquire(blocking=False):
+                bot.reply_to(message, MSG_BACKUP_RUNNING, parse_mode="Markdown")
+                return
             
-            # Execute backup in separate thread
+            # Execute backup on the backup worker
             def run_backup_and_notify():
-                success = run_backup_process(force=True)
-                if not success:
-                    error_msg = "❌ *خطا در بکاپ‌گیری*\n\n" \
-                               "🔴 عملیات بکاپ با خطا مواجه شد\n" \
-                               "📋 لطفاً لاگ‌ها را بررسی کنید"
-                    bot.send_message(message.chat.id, error_msg, parse_mode="Markdown")
+                try:
+                    success = run_backup_process(force=True)
+                    if success is None:
+                        bot.send_message(message.chat.id, MSG_BACKUP_RUNNING, parse_mode="Markdown")
+                    elif not success:
+                        bot.send_message(message.chat.id, MSG_BACKUP_ERROR, parse_mode="Markdown")
+                finally:
+                    backup_pending.release()
             
-            threading.Thread(target=run_backup_and_notify).start()
+            try:
+                # Send start message
+                bot.reply_to(message, MSG_BACKUP_START, parse_mode="Markdown")
+                BACKUP_POOL.submit(run_backup_and_notify)
+            except Exception:
+                # The job never got queued, so nothing else will release the flag
+                backup_pending.release()
+                raise
         
         @bot.message_handler(commands=['status'])
         def handle_status_command(message):
@@ -454,14 +673,12 @@ def main():
             global chat_id
             
             # Check user permission
-            if str(message.chat.id) != str(chat_id):
-                unauthorized_msg = "🚫 *دسترسی غیرمجاز*\n\n" \
-                                 "❌ شما مجوز اجرای این دستور را ندارید"
-                bot.reply_to(message, unauthorized_msg, parse_mode="Markdown")
+            if message.chat.id != chat_id:
+                bot.reply_to(message, MSG_UNAUTHORIZED, parse_mode="Markdown")
                 return
             
             # Get last backup status
-            config_data = load_config()
+            config_data = get_config()
             last_backup = config_data.get('last_backup')
             min_interval = config_data.get('min_interval_hours', MIN_INTERVAL_HOURS)
             
@@ -492,31 +709,22 @@ def main():
             global chat_id
             
             # Check user permission
-            if str(message.chat.id) != str(chat_id):
-                unauthorized_msg = "🚫 *دسترسی غیرمجاز*\n\n" \
-                                 "❌ شما مجوز اجرای این دستور را ندارید"
-                bot.reply_to(message, unauthorized_msg, parse_mode="Markdown")
+            if message.chat.id != chat_id:
+                bot.reply_to(message, MSG_UNAUTHORIZED, parse_mode="Markdown")
                 return
             
             parts = message.text.split()
             if len(parts) < 2 or not parts[1].isdigit():
-                help_msg = "⚙️ *تنظیم فاصله زمانی*\n\n" \
-                          "📝 لطفاً یک عدد صحیح به عنوان فاصله زمانی (ساعت) وارد کنید\n\n" \
-                          "💡 *مثال:* `/time 8`"
-                bot.reply_to(message, help_msg, parse_mode="Markdown")
+                bot.reply_to(message, MSG_TIME_HELP, parse_mode="Markdown")
                 return
             
             new_interval = int(parts[1])
             if new_interval <= 0:
-                error_msg = "❌ *خطا در مقدار*\n\n" \
-                           "🔴 فاصله زمانی باید عددی بزرگتر از صفر باشد"
-                bot.reply_to(message, error_msg, parse_mode="Markdown")
+                bot.reply_to(message, MSG_TIME_INVALID, parse_mode="Markdown")
                 return
             
-            # Load, update, and save config
-            config_data = load_config()
-            config_data['min_interval_hours'] = new_interval
-            if save_config(config_data):
+            # Update and save config
+            if update_config(min_interval_hours=new_interval):
                 # Update the global variable as well
                 global MIN_INTERVAL_HOURS
                 MIN_INTERVAL_HOURS = new_interval
@@ -525,10 +733,7 @@ def main():
                              f"💾 تنظیمات ذخیره شد"
                 bot.reply_to(message, success_msg, parse_mode="Markdown")
             else:
-                error_msg = "❌ *خطا در ذخیره*\n\n" \
-                           "🔴 خطا در ذخیره تنظیمات\n" \
-                           "📋 لطفاً لاگ‌ها را بررسی کنید"
-                bot.reply_to(message, error_msg, parse_mode="Markdown")
+                bot.reply_to(message, MSG_SAVE_ERROR, parse_mode="Markdown")
         
         @bot.message_handler(commands=['restore'])
         def handle_restore_command(message):
@@ -536,26 +741,15 @@ def main():
             global chat_id, user_states
             
             # Check user permission
-            if str(message.chat.id) != str(chat_id):
-                unauthorized_msg = "🚫 *دسترسی غیرمجاز*\n\n" \
-                                 "❌ شما مجوز اجرای این دستور را ندارید"
-                bot.reply_to(message, unauthorized_msg, parse_mode="Markdown")
+            if message.chat.id != chat_id:
+                bot.reply_to(message, MSG_UNAUTHORIZED, parse_mode="Markdown")
                 return
             
             # Set user state to waiting for file
             user_states[message.chat.id] = 'waiting_restore'
             
             # Send guide message
-            guide_msg = "⚠️ *هشدار بسیار مهم*\n\n" \
-                       "🔴 عملیات بازیابی دیتابیس موجود را حذف کرده و با بکاپ جدید جایگزین خواهد کرد\n\n" \
-                       "📎 *فرمت‌های پشتیبانی شده:*\n" \
-                       "• `.bak`\n" \
-                       "• `.dump.gz`\n\n" \
-                       "📤 لطفاً فایل بکاپ معتبر را ارسال کنید\n\n" \
-                       "❌ برای لغو:" \
-                       "/cancel"
-            
-            bot.reply_to(message, guide_msg, parse_mode="Markdown")
+            bot.reply_to(message, MSG_RESTORE_GUIDE, parse_mode="Markdown")
         
         @bot.message_handler(commands=['cancel'])
         def handle_cancel_command(message):
@@ -563,22 +757,16 @@ def main():
             global user_states
             
             # Check user permission
-            if str(message.chat.id) != str(chat_id):
-                unauthorized_msg = "🚫 *دسترسی غیرمجاز*\n\n" \
-                                 "❌ شما مجوز اجرای این دستور را ندارید"
-                bot.reply_to(message, unauthorized_msg, parse_mode="Markdown")
+            if message.chat.id != chat_id:
+                bot.reply_to(message, MSG_UNAUTHORIZED, parse_mode="Markdown")
                 return
             
             # Check user state
             if user_states.get(message.chat.id) == 'waiting_restore':
                 user_states[message.chat.id] = None
-                cancel_msg = "✅ *عملیات لغو شد*\n\n" \
-                           "🔄 عملیات بازیابی با موفقیت لغو شد"
-                bot.reply_to(message, cancel_msg, parse_mode="Markdown")
+                bot.reply_to(message, MSG_CANCELLED, parse_mode="Markdown")
             else:
-                no_operation_msg = "❌ *هیچ عملیات فعال نیست*\n\n" \
-                                  "⚪ هیچ عملیات فعال برای لغو وجود ندارد"
-                bot.reply_to(message, no_operation_msg, parse_mode="Markdown")
+                bot.reply_to(message, MSG_NO_OPERATION, parse_mode="Markdown")
         
         @bot.message_handler(content_types=['document'])
         def handle_document(message):
@@ -586,41 +774,57 @@ def main():
             global user_states
             
             # Check user permission
-            if str(message.chat.id) != str(chat_id):
+            if message.chat.id != chat_id:
                 return
             
-            # Check user state
-            if user_states.get(message.chat.id) != 'waiting_restore':
+            # Fetch and clear the user state in one step, so two documents sent
+            # back-to-back cannot both start a restore
+            if user_states.pop(message.chat.id, None) != 'waiting_restore':
                 return
             
-            # Get file info
-            file_info = bot.get_file(message.document.file_id)
-            file_name = message.document.file_name
+            # Keep only the base name so a crafted file name cannot escape TEMP_DIR
+            file_name = os.path.basename(message.document.file_name or "")
             
             # Check file extension (only check type and extension)
-            if not (file_name.endswith('.bak') or file_name.endswith('.dump.gz')):
-                invalid_format_msg = "❌ *فرمت فایل نامعتبر*\n\n" \
-                                    "🔴 پسوند فایل معتبر نیست\n\n" \
-                                    "✅ *فرمت‌های مجاز:*\n" \
-                                    "• `.bak`\n" \
-                                    "• `.dump.gz`"
-                bot.reply_to(message, invalid_format_msg, parse_mode="Markdown")
+            if not file_name.endswith(('.bak', '.dump.gz')):
+                user_states[message.chat.id] = 'waiting_restore'  # Let the user send another file
+                bot.reply_to(message, MSG_INVALID_FORMAT, parse_mode="Markdown")
                 return
             
-            # Download file
+            # Download file (file_path is set only once this handler has created its own file)
+            file_path = None
             try:
-                downloaded_file = bot.download_file(file_info.file_path)
-                
-                # Save file in temporary directory
-                file_path = os.path.join(TEMP_DIR, file_name)
-                with open(file_path, 'wb') as f:
-                    f.write(downloaded_file)
+                # Get file info
+                file_info = bot.get_file(message.document.file_id)
                 
-                # Reset user state
-                user_states[message.chat.id] = None
+                # Stream the file into the temporary directory in 1 MiB chunks instead of holding it in memory
+                with SESSION.get(
+                    GET_FILE_URL.format(bot.token, file_info.file_path),
+                    stream=True,
+                    timeout=(5, 300)
+                ) as resp:
+                    resp.raise_for_status()
+                    resp.raw.decode_content = True
+                    
+                    # Reject a .dump.gz that is not gzip before writing anything to disk
+                    head = resp.raw.read(2)
+                    if file_name.endswith('.dump.gz') and head != GZIP_MAGIC:
+                        user_states[message.chat.id] = 'waiting_restore'
+                        bot.reply_to(message, MSG_INVALID_GZIP, parse_mode="Markdown")
+                        return
+                    
+                    # A unique name, so a restore that is queued or running never shares its file with this one
+                    fd, file_path = tempfile.mkstemp(
+                        dir=TEMP_DIR,
+                        prefix='restore_',
+                        suffix='.dump.gz' if file_name.endswith('.dump.gz') else '.bak'
+                    )
+                    with open(fd, 'wb') as f:
+                        f.write(head)
+                        shutil.copyfileobj(resp.raw, f, length=1 << 20)
                 
                 # Get file size for display
-                file_size = len(downloaded_file)
+                file_size = os.path.getsize(file_path)
                 file_size_mb = round(file_size / (1024 * 1024), 2)
                 
                 # Send start message
@@ -632,22 +836,38 @@ def main():
                 
                 bot.reply_to(message, start_restore_msg, parse_mode="Markdown")
                 
-                # Execute restore in separate thread
-                threading.Thread(target=run_restore_process, args=(file_path, message.chat.id)).start()
+                # Execute restore on the backup worker so it never overlaps a bot-triggered backup
+                BACKUP_POOL.submit(run_restore_process, file_path, message.chat.id)
                 
             except Exception as e:
+                user_states[message.chat.id] = 'waiting_restore'
+                # Don't leave a partially streamed file behind in the temporary directory
+                if file_path:
+                    try:
+                        os.remove(file_path)
+                    except OSError:
+                        pass
+                # requests errors carry the /file/bot<TOKEN>/ URL: log them masked, show the user only the status
+                print(f"❌ Error downloading restore file: {redact_token(str(e), bot.token)}")
+                if isinstance(e, requests.HTTPError) and e.response is not None:
+                    error_text = f"HTTP {e.response.status_code}"
+                elif isinstance(e, requests.RequestException):
+                    error_text = "خطای ارتباط با سرور تلگرام"
+                else:
+                    error_text = redact_token(str(e), bot.token)
                 download_error_msg = f"❌ *خطا در دانلود فایل*\n\n" \
-                                   f"🔴 خطا: `{str(e)}`"
+                                   f"🔴 خطا: `{error_text}`"
                 bot.reply_to(message, download_error_msg, parse_mode="Markdown")
         
         # Start Telegram bot in separate thread
+        # infinity_polling reconnects on its own; long polls keep idle getUpdates traffic low
         def bot_polling():
-            while not shutdown_flag:
-                try:
-                    bot.polling(non_stop=True, interval=1, timeout=10)
-                except Exception as e:
-                    print(f"❌ Error in Telegram bot: {str(e)}")
-                    time.sleep(5)
+            bot.infinity_polling(
+                timeout=TELEGRAM_LONG_POLL_SECONDS,
+                long_polling_timeout=TELEGRAM_LONG_POLL_SECONDS,
+                allowed_updates=['message'],
+                logger_level=logging.ERROR
+            )
         
         threading.Thread(target=bot_polling, daemon=True).start()
         print("🤖 Telegram bot activated")
@@ -658,8 +878,7 @@ def main():
     threading.Thread(target=backup_polling_thread, daemon=True).start()
     
     # Wait for shutdown signal
-    while not shutdown_flag:
-        time.sleep(1)
+    shutdown_event.wait()
     
     print("🛑 Script stopped successfully")
     sys.exit(0)
@@ -220,7 +220,7 @@ for pkg in docker docker.io containerd runc; do
 done
 
 # Install prerequisites
-apt-get install -y git jq ca-certificates curl gnupg lsb-release python3-pip python3-venv dialog whiptail apt-utils
+apt-get install -y git jq ca-certificates curl gnupg lsb-release python3-pip python3-venv dialog whiptail apt-utils pigz
 
 # If a domain has been specified, install Caddy for reverse proxy/SSL
 if [ -n "$DOMAIN" ]; then
@@ -282,7 +282,7 @@ fi
 source "$VENV_DIR/bin/activate"
 
 # Install Python dependencies using the venv's pip
-if ! "$VENV_DIR/bin/python3" -m pip install pyTelegramBotAPI jdatetime; then
+if ! "$VENV_DIR/bin/python3" -m pip install pyTelegramBotAPI jdatetime requests requests-toolbelt orjson; then
     echo "Error: Failed to install Python dependencies in the virtual environment"
     deactivate
     exit 1
@@ -601,6 +601,7 @@ Wants=network-online.target
 [Service]
 Type=simple
 ExecStart=${VENV_DIR}/bin/python3 ${BACKUP_DIR}/bot.py
+ExecReload=/bin/kill -HUP \$MAINPID
 Restart=always
 RestartSec=3
 LimitNOFILE=1048576